@@ -35,6 +35,10 @@ class AppSettings(BaseSettings):
     azure_openai_endpoint: str = Field(..., validation_alias="AZURE_OPENAI_ENDPOINT")
     azure_openai_gpt_deployment: str = Field(..., validation_alias="AZURE_OPENAI_GPT_DEPLOYMENT")
     azure_openai_embedding_deployment: str = Field("", validation_alias="AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+    # Smaller deployment used only for NL->SQL generation (falls back to the GPT deployment when empty)
+    azure_openai_sql_deployment: str = Field("", validation_alias="AZURE_OPENAI_SQL_DEPLOYMENT")
+    # When enabled, also generate SQL with the GPT deployment and log both candidates for comparison
+    azure_openai_sql_deployment_compare: bool = Field(False, validation_alias="AZURE_OPENAI_SQL_DEPLOYMENT_COMPARE")
     azure_openai_api_version: str = Field(..., validation_alias="AZURE_OPENAI_API_VERSION")
     
     # Azure AI Search Settings
@@ -46,6 +50,9 @@ class AppSettings(BaseSettings):
     azure_sql_server: str = Field(..., validation_alias="AZURE_SQL_SERVER")
     azure_sql_database: str = Field("arclog", validation_alias="AZURE_SQL_DATABASE_NAME")
     use_aad: bool = Field(..., validation_alias="USE_AAD")
+    # Seconds NL->SQL generation may run before the safe fallback query starts speculatively.
+    # 2.0 sits above a typical single chat completion, so only slow generations pay for the extra query
+    sql_fallback_delay_seconds: float = Field(2.0, validation_alias="SQL_FALLBACK_DELAY_SECONDS")
 
     # Log Analytics Settings
     azure_log_analytics_workspace_resource_id: str = Field(..., validation_alias="LOG_ANALYTICS_WORKSPACE_RESOURCE_ID")
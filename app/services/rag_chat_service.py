@@ -106,7 +106,8 @@ class RagChatService:
                     inv_results = self.search_client_inventories.search(
                         search_text=effective_query,
                         top=1,
-                        select="content"
+                        select="content",
+                        filter="source eq 'inventories'"
                     )
                     _accumulate('Inventories', inv_results)
                 except Exception as se:
@@ -117,7 +118,8 @@ class RagChatService:
                     inc_results = self.search_client_incidents.search(
                         search_text=effective_query,
                         top=top_k,
-                        select="content"
+                        select="content",
+                        filter="source eq 'incidents'"
                     )
                     _accumulate('Incident', inc_results)
                 except Exception as se:
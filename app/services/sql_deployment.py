@@ -0,0 +1,34 @@
+"""
+Shared NL->SQL deployment routing for the SQL query services
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+async def complete_sql(
+    complete: Callable[[str, str], Awaitable[str]],
+    prompt: str,
+    sql_deployment: str,
+    gpt_deployment: str,
+    compare: bool,
+) -> str:
+    """Generate SQL with the SQL deployment.
+
+    When compare is enabled (and the deployments differ), the GPT deployment is
+    asked as well and both candidates are logged; the SQL deployment's answer is
+    always the one returned.
+    """
+    if compare and sql_deployment != gpt_deployment:
+        sql, baseline_sql = await asyncio.gather(
+            complete(prompt, sql_deployment),
+            complete(prompt, gpt_deployment),
+            return_exceptions=True,
+        )
+        logger.info("SQL candidates: %s=%r, %s=%r", sql_deployment, sql, gpt_deployment, baseline_sql)
+        if isinstance(sql, BaseException):
+            raise sql
+        return sql
+    return await complete(prompt, sql_deployment)
@@ -2,16 +2,22 @@
 """
 import logging
 import asyncio
+import re
 import struct
+import sys
 from typing import List, Any, Dict
 
 import pyodbc  # type: ignore
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 from openai import AsyncAzureOpenAI
 from app.config import settings
+from app.services.sql_deployment import complete_sql
 
 logger = logging.getLogger(__name__)
 
+_FORBIDDEN_SQL_RE = re.compile(r"update|delete|insert|merge|drop|alter|truncate", re.IGNORECASE)
+_TABLE_REFERENCE_RE = re.compile(r"\s(?:from|join)\s+(\S+)", re.IGNORECASE)
+
 class SQLQueryService:
     """
     Service that provides SQL query capabilities
@@ -21,6 +27,8 @@ class SQLQueryService:
         # Store settings
         self.openai_endpoint = settings.azure_openai_endpoint
         self.gpt_deployment = settings.azure_openai_gpt_deployment
+        self.sql_deployment = settings.azure_openai_sql_deployment or self.gpt_deployment
+        self.sql_deployment_compare = settings.azure_openai_sql_deployment_compare
         self.embedding_deployment = settings.azure_openai_embedding_deployment
         self.search_url = settings.azure_search_service_url
         self.search_index_name_inventories = settings.azure_search_index_name_inventories
@@ -97,6 +105,21 @@ class SQLQueryService:
             ");"
         )
 
+    async def _complete_sql(self, prompt: str, deployment: str) -> str:
+        """Ask the given deployment for SQL and strip any markdown fences."""
+        resp = await self.openai_client.chat.completions.create(
+            model=deployment,
+            messages=[{"role": "user", "content": prompt}]
+        )
+        sql = resp.choices[0].message.content.strip()
+        # Strip code fences if any
+        if sql.startswith("```"):
+            sql = sql.strip("`\n")
+            # remove possible language tag line
+            if sql.lower().startswith("sql"):
+                sql = "\n".join(sql.splitlines()[1:])
+        return sql
+
     async def _generate_sql(self, user_query: str) -> str:
         """Generate a read-only SQL query."""
         prompt = (
@@ -118,20 +141,11 @@ class SQLQueryService:
             "Generate ONLY the SQL query without any explanation or markdown formatting:"
         )
         try:
-            resp = await self.openai_client.chat.completions.create(
-                model=self.gpt_deployment,
-                messages=[{"role": "user", "content": prompt}]
+            return await complete_sql(
+                self._complete_sql, prompt, self.sql_deployment, self.gpt_deployment, self.sql_deployment_compare
             )
-            sql = resp.choices[0].message.content.strip()
-            # Strip code fences if any
-            if sql.startswith("```"):
-                sql = sql.strip("`\n")
-                # remove possible language tag line
-                if sql.lower().startswith("sql"):
-                    sql = "\n".join(sql.splitlines()[1:])
-            return sql
         except Exception as e:
-            logger.error(f"Failed to generate SQL: {e}")
+            logger.error("Failed to generate SQL: %s", e)
             # fallback simple query
             return f"SELECT TOP {self._default_row_limit} name, location, vm_size, power_state FROM dbo.virtual_machines ORDER BY name;"
 
@@ -154,31 +168,28 @@ class SQLQueryService:
     async def _execute_sql(self, sql: str) -> List[Dict[str, Any]]:
         """Execute SQL synchronously in a thread and return list of dict rows."""
         def _work() -> List[Dict[str, Any]]:
+            logger.debug("Executing SQL query: %s", sql)
             with self._build_connection() as conn:
                 cur = conn.cursor()
                 cur.execute(sql)
-                cols = [c[0] for c in cur.description] if cur.description else []
+                cols = [sys.intern(c[0]) for c in cur.description] if cur.description else []
                 rows = cur.fetchall() if cols else []
+                logger.debug("SQL query returned %d rows", len(rows))
                 return [dict(zip(cols, r)) for r in rows]
         return await asyncio.to_thread(_work)
 
     # --- Safety / formatting ---------------------------------------------------
     def _is_safe_sql(self, sql: str) -> bool:
-        lowered = sql.lower()
-        forbidden = ["update", "delete", "insert", "merge", "drop", "alter", "truncate"]
-        if any(f in lowered for f in forbidden):
+        if _FORBIDDEN_SQL_RE.search(sql):
             return False
         # ensure only allowed tables referenced (simple heuristic)
-        for token in [" from ", " join "]:
-            parts = lowered.split(token)
-            if len(parts) > 1:
-                # check following identifier
-                for seg in parts[1:]:
-                    ident = seg.strip().split()[0].strip('[];,')
-                    if ident.startswith("dbo."):
-                        ident = ident[4:]
-                    if ident and ident not in self._allowed_tables:
-                        return False
+        # single pass over FROM/JOIN targets, stopping at the first disallowed table
+        for match in _TABLE_REFERENCE_RE.finditer(sql):
+            ident = match.group(1).strip('[];,').lower()
+            if ident.startswith("dbo."):
+                ident = ident[4:]
+            if ident and ident not in self._allowed_tables:
+                return False
         return True
 
     def _rows_to_sources(self, rows: List[Dict[str, Any]], max_chars: int = 4000) -> str:
@@ -186,10 +197,17 @@ class SQLQueryService:
             return "(no rows)"
         # simple tabular text (pipe separated)
         cols = list(rows[0].keys())
-        lines = [" | ".join(cols)]
-        for r in rows:
-            lines.append(" | ".join(str(r.get(c, "")) for c in cols))
-            if sum(len(line) for line in lines) > max_chars:
+        header = " | ".join(cols)
+
+        def _fmt(r: Dict[str, Any]) -> str:
+            return " | ".join(str(r[c]) for c in cols)
+
+        lines = [header]
+        total = len(header)
+        for line in map(_fmt, rows):
+            lines.append(line)
+            total += len(line)
+            if total > max_chars:
                 lines.append("... (truncated) ...")
                 break
         return "\n".join(lines)
@@ -199,7 +217,7 @@ class SQLQueryService:
         try:
             sql = await self._generate_sql(effective_query)
             if not self._is_safe_sql(sql):
-                logger.warning(f"Unsafe SQL blocked: {sql}")
+                logger.warning("Unsafe SQL blocked: %s", sql)
                 sql = f"SELECT TOP {self._default_row_limit} name, location, vm_size, power_state FROM dbo.virtual_machines ORDER BY name;"  # safe fallback
 
             rows = await self._execute_sql(sql)
@@ -207,7 +225,7 @@ class SQLQueryService:
 
             return [{"title": "SQL Query", "content": f"SQL Query:\n{sql}\n\nResults:\n{sources}"}]
         except Exception as e:
-            logger.error(f"Error in get_chat_completion: {e}")
+            logger.error("Error in get_chat_completion: %s", e)
             raise
 
 sql_query_auto_service = SQLQueryService()
@@ -2,16 +2,32 @@
 """
 import logging
 import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import re
 import struct
-from typing import List, Any, Dict
+import sys
+from typing import FrozenSet, List, Any, Dict, Optional, Tuple
 
 import pyodbc  # type: ignore
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 from openai import AsyncAzureOpenAI
 from app.config import settings
+from app.services.sql_deployment import complete_sql
 
 logger = logging.getLogger(__name__)
 
+_FORBIDDEN_SQL_RE = re.compile(r"update|delete|insert|merge|drop|alter|truncate", re.IGNORECASE)
+_TABLE_REFERENCE_RE = re.compile(r"\s(?:from|join)\s+(\S+)", re.IGNORECASE)
+# Wording that asks for filtering, ordering or a row limit; such questions need the LLM, not a template
+_REFINEMENT_RE = re.compile(
+    r"\b(?:where|only|top|first|last|limit|order|sort\w*|filter\w*|between|greater|less|more|fewer|above|below"
+    r"|over|under|contain\w*|like|match\w*|named|called|running|stopped|deallocated|latest|newest|oldest|recent"
+    r"|not|without|except|exclud\w*)\b|\b(?:top|first|last|limit)\s*\d+"
+    r"|以上|以下|未満|上位|下位|順|のみ|だけ|以外|除|含|停止|実行中|最新|最も|\d+\s*件",
+    re.IGNORECASE,
+)
+
 class SQLQueryService:
     """
     Service that provides SQL query capabilities
@@ -21,6 +37,8 @@ class SQLQueryService:
         # Store settings
         self.openai_endpoint = settings.azure_openai_endpoint
         self.gpt_deployment = settings.azure_openai_gpt_deployment
+        self.sql_deployment = settings.azure_openai_sql_deployment or self.gpt_deployment
+        self.sql_deployment_compare = settings.azure_openai_sql_deployment_compare
         self.azure_openai_api_version = settings.azure_openai_api_version
 
         # Create Azure credentials for managed identity
@@ -49,6 +67,11 @@ class SQLQueryService:
         self._sql_scope = "https://database.windows.net/.default"
         self._allowed_tables = {"virtual_machines", "network_interfaces", "installed_software"}
         self._default_row_limit = 50
+        self._fallback_sql = f"SELECT TOP {self._default_row_limit} name, location, vm_size, power_state FROM dbo.virtual_machines ORDER BY name;"
+        # The speculative fallback only starts once SQL generation has run this long (SQL_FALLBACK_DELAY_SECONDS),
+        # and runs on a single dedicated worker so at most one fallback query hits the database at any time
+        self._fallback_delay = settings.sql_fallback_delay_seconds
+        self._fallback_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sql-fallback")
 
         self.table_info = (
             "TABLE dbo.virtual_machines (\n"
@@ -92,8 +115,58 @@ class SQLQueryService:
             ");"
         )
 
+        # Precompiled SQL for common column selections (keys are lower-cased "table.column" labels).
+        # These skip the LLM round-trip only when the question adds no filter, ordering or limit;
+        # anything else falls back to _generate_sql's LLM call.
+        self._sql_templates: Dict[FrozenSet[str], str] = {
+            frozenset({
+                "virtual_machines.name", "virtual_machines.location",
+                "virtual_machines.vm_size", "virtual_machines.power_state",
+            }): (
+                "SELECT vm.name, vm.location, vm.vm_size, vm.power_state\n"
+                "FROM dbo.virtual_machines AS vm\n"
+                "ORDER BY vm.name;"
+            ),
+            frozenset({
+                "virtual_machines.resource_group", "virtual_machines.name", "network_interfaces.name",
+            }): (
+                "SELECT vm.resource_group, vm.name AS resource_name, ni.name AS network_interface_name\n"
+                "FROM dbo.virtual_machines AS vm\n"
+                "LEFT OUTER JOIN dbo.network_interfaces AS ni ON vm.resource_id = ni.vm_resource_id\n"
+                "ORDER BY vm.resource_group, vm.name;"
+            ),
+            frozenset({
+                "virtual_machines.name", "network_interfaces.name", "network_interfaces.private_ip",
+            }): (
+                "SELECT vm.name AS resource_name, ni.name AS network_interface_name, ni.private_ip\n"
+                "FROM dbo.virtual_machines AS vm\n"
+                "LEFT OUTER JOIN dbo.network_interfaces AS ni ON vm.resource_id = ni.vm_resource_id\n"
+                "ORDER BY vm.name, ni.name;"
+            ),
+            frozenset({
+                "virtual_machines.name", "installed_software.software_name", "installed_software.current_version",
+            }): (
+                "SELECT vm.name AS resource_name, sw.software_name, sw.current_version\n"
+                "FROM dbo.virtual_machines AS vm\n"
+                "LEFT OUTER JOIN dbo.installed_software AS sw ON vm.name = sw.computer_name\n"
+                "ORDER BY vm.name, sw.software_name;"
+            ),
+        }
+
+    def _template_for(self, wanted_columns: List[str], user_query: str) -> Optional[str]:
+        """Precompiled SQL for the selection, or None when the question needs the LLM."""
+        key = frozenset(c.strip().lower() for c in wanted_columns)
+        template = self._sql_templates.get(key)
+        if template is None:
+            logger.debug("No SQL template for columns %s", sorted(key))
+            return None
+        if _REFINEMENT_RE.search(user_query):
+            logger.debug("SQL template skipped; query asks for filtering, ordering or a limit")
+            return None
+        return template
+
     async def _generate_sql(self, wanted_columns: List[str], user_query: str) -> str:
-        """Generate a read-only SQL query."""
+        """Generate a read-only SQL query with the LLM."""
         prompt = (
             "You are an expert SQL query generator for Azure infrastructure data. Generate a read-only SQL query based on the user's requirements.\n\n"
             f"User Query: {user_query}\n"
@@ -114,15 +187,21 @@ class SQLQueryService:
             "ORDER BY vm.resource_group, vm.name;\n\n"
             "Generate ONLY the SQL query without any explanation or markdown formatting:"
         )
-        
+
+        return await complete_sql(
+            self._complete_sql, prompt, self.sql_deployment, self.gpt_deployment, self.sql_deployment_compare
+        )
+
+    async def _complete_sql(self, prompt: str, deployment: str) -> str:
+        """Ask the given deployment for SQL."""
         resp_sql = await self.openai_client.chat.completions.create(
-            model=self.gpt_deployment,
+            model=deployment,
             messages=[{"role": "user", "content": prompt}],
             temperature=0.1,
         )
 
         return resp_sql.choices[0].message.content.strip()
-        
+
 
     # --- SQL Execution helpers -------------------------------------------------
     def _build_connection(self) -> pyodbc.Connection:
@@ -140,34 +219,31 @@ class SQLQueryService:
             return pyodbc.connect(conn_str, attrs_before=attrs_before)
         raise RuntimeError("Azure SQL connection failed: AAD enabled but token acquisition failed or SQL Auth credentials missing")
 
-    async def _execute_sql(self, sql: str) -> List[Dict[str, Any]]:
-        """Execute SQL synchronously in a thread and return list of dict rows."""
+    async def _execute_sql(self, sql: str, executor: Optional[ThreadPoolExecutor] = None) -> List[Dict[str, Any]]:
+        """Execute SQL synchronously in a thread (default pool unless executor is given) and return list of dict rows."""
         def _work() -> List[Dict[str, Any]]:
+            logger.debug("Executing SQL query: %s", sql)
             with self._build_connection() as conn:
                 cur = conn.cursor()
                 cur.execute(sql)
-                cols = [c[0] for c in cur.description] if cur.description else []
+                cols = [sys.intern(c[0]) for c in cur.description] if cur.description else []
                 rows = cur.fetchall() if cols else []
+                logger.debug("SQL query returned %d rows", len(rows))
                 return [dict(zip(cols, r)) for r in rows]
-        return await asyncio.to_thread(_work)
+        return await asyncio.get_running_loop().run_in_executor(executor, _work)
 
     # --- Safety / formatting ---------------------------------------------------
     def _is_safe_sql(self, sql: str) -> bool:
-        lowered = sql.lower()
-        forbidden = ["update", "delete", "insert", "merge", "drop", "alter", "truncate"]
-        if any(f in lowered for f in forbidden):
+        if _FORBIDDEN_SQL_RE.search(sql):
             return False
         # ensure only allowed tables referenced (simple heuristic)
-        for token in [" from ", " join "]:
-            parts = lowered.split(token)
-            if len(parts) > 1:
-                # check following identifier
-                for seg in parts[1:]:
-                    ident = seg.strip().split()[0].strip('[];,')
-                    if ident.startswith("dbo."):
-                        ident = ident[4:]
-                    if ident and ident not in self._allowed_tables:
-                        return False
+        # single pass over FROM/JOIN targets, stopping at the first disallowed table
+        for match in _TABLE_REFERENCE_RE.finditer(sql):
+            ident = match.group(1).strip('[];,').lower()
+            if ident.startswith("dbo."):
+                ident = ident[4:]
+            if ident and ident not in self._allowed_tables:
+                return False
         return True
 
     def _rows_to_sources(self, rows: List[Dict[str, Any]], max_chars: int = 4000) -> str:
@@ -177,10 +253,35 @@ class SQLQueryService:
         cols = list(rows[0].keys())
         header = " | ".join(cols)
         separator = " | ".join(["---"] * len(cols))
-        lines = [header, separator]
-        for r in rows:
-            lines.append(" | ".join(str(r.get(c, "")) for c in cols))
-        return "\n".join(lines)
+
+        def _fmt(r: Dict[str, Any]) -> str:
+            return " | ".join(str(r[c]) for c in cols)
+
+        return "\n".join(itertools.chain((header, separator), map(_fmt, rows)))
+
+    async def _generate_and_execute(self, wanted_columns: List[str], user_query: str) -> Tuple[str, List[Dict[str, Any]]]:
+        """Generate SQL with the LLM and run it, falling back to the safe query when it is blocked."""
+        # Slow generations get the safe fallback running speculatively, so a blocked query
+        # doesn't pay for both round-trips back to back
+        sql_task = asyncio.create_task(self._generate_sql(wanted_columns, user_query))
+        fallback_task = None
+        try:
+            done, _ = await asyncio.wait({sql_task}, timeout=self._fallback_delay)
+            if not done:
+                fallback_task = asyncio.create_task(self._execute_sql(self._fallback_sql, self._fallback_executor))
+                fallback_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            sql = await sql_task
+            if self._is_safe_sql(sql):
+                return sql, await self._execute_sql(sql)
+            logger.warning("Unsafe SQL blocked: %s", sql)
+            # safe fallback
+            if fallback_task is not None:
+                return self._fallback_sql, await fallback_task
+            return self._fallback_sql, await self._execute_sql(self._fallback_sql)
+        finally:
+            sql_task.cancel()
+            if fallback_task is not None:
+                fallback_task.cancel()
 
     async def get_chat_completion(self, effective_query: str):
         """End-to-end chat completion with Azure SQL retrieval."""
@@ -195,18 +296,19 @@ class SQLQueryService:
                     WHERE TABLE_NAME IN ({','.join(quoted_items)})
                     ORDER BY TABLE_NAME, ORDINAL_POSITION;
                 """
-                logger.info(f"Executing SQL for columns: {sql}")
+                logger.debug("Executing SQL for columns: %s", sql)
                 rows = await self._execute_sql(sql)
                 columns = self._rows_to_sources(rows)
                 return [{"title": "COLUMNS", "content": f";;COLUMNS;;{columns}"}]
             elif effective_query.upper().startswith(";;EXECUTE;;"):
-                [wanted_columns, user_query] = effective_query.split("|||")
-                sql = await self._generate_sql(wanted_columns, user_query)
-                if not self._is_safe_sql(sql):
-                    logger.warning(f"Unsafe SQL blocked: {sql}")
-                    sql = f"SELECT TOP {self._default_row_limit} name, location, vm_size, power_state FROM dbo.virtual_machines ORDER BY name;"  # safe fallback
-
-                rows = await self._execute_sql(sql)
+                [wanted_part, user_query] = effective_query.split("|||")
+                wanted_columns = [c for c in wanted_part[len(";;EXECUTE;;"):].split(",") if c.strip()]
+                template = self._template_for(wanted_columns, user_query)
+                if template is not None:
+                    sql = template
+                    rows = await self._execute_sql(sql)
+                else:
+                    sql, rows = await self._generate_and_execute(wanted_columns, user_query)
 
                 sources = self._rows_to_sources(rows)
 
@@ -214,7 +316,7 @@ class SQLQueryService:
             else:
                 return [{'title': 'SELECTABLE', 'content': f';;SELECTABLE;;{",".join("dbo." + table for table in self._allowed_tables)}'}]
         except Exception as e:
-            logger.error(f"Error in get_chat_completion: {e}")
+            logger.error("Error in get_chat_completion: %s", e)
             raise
 
 sql_query_manual_service = SQLQueryService()
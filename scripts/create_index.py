@@ -1,9 +1,38 @@
+import asyncio
+import functools
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import orjson
 from dotenv import load_dotenv
 import requests  # type: ignore[import-untyped]
+from requests.adapters import HTTPAdapter  # type: ignore[import-untyped]
+from urllib3.util.retry import Retry
 from azure.search.documents.indexes import SearchIndexClient, SearchIndexerClient
-from azure.search.documents.indexes.models import SearchIndexer, FieldMapping
-from azure.core.exceptions import ResourceExistsError
+from azure.search.documents.indexes.models import (
+    FieldMapping,
+    FieldMappingFunction,
+    HnswAlgorithmConfiguration,
+    HnswParameters,
+    IndexingParameters,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
+    SearchField,
+    SearchFieldDataType,
+    SearchIndex,
+    SearchIndexer,
+    SemanticConfiguration,
+    SemanticField,
+    SemanticPrioritizedFields,
+    SemanticSearch,
+    VectorSearch,
+    VectorSearchProfile,
+)
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.identity import DefaultAzureCredential
 
 load_dotenv()
@@ -14,13 +43,59 @@ search_service_endpoint = f"https://{search_service_name}.search.windows.net" if
 storage_account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
 storage_account_resource_id = os.getenv("AZURE_STORAGE_ACCOUNT_RESOURCE_ID") 
 
-credential = DefaultAzureCredential()
-index_client = SearchIndexClient(endpoint=search_service_endpoint, credential=credential)
-indexer_client = SearchIndexerClient(endpoint=search_service_endpoint, credential=credential)
+@functools.cache
+def get_credential():
+    """Shared credential, built on first use; skips the interactive/IDE providers this script never uses"""
+    return DefaultAzureCredential(
+        exclude_interactive_browser_credential=True,
+        exclude_visual_studio_code_credential=True,
+    )
 
-def create_data_source_via_rest(data_source_name, search_service_endpoint, credential, storage_account_resource_id, container_name):
+@functools.cache
+def get_search_transport():
+    """One HTTP transport (and keep-alive pool) shared by the index and indexer clients"""
+    return RequestsTransport()
+
+@functools.cache
+def get_index_client():
+    return SearchIndexClient(endpoint=search_service_endpoint, credential=get_credential(), transport=get_search_transport())
+
+@functools.cache
+def get_indexer_client():
+    return SearchIndexerClient(endpoint=search_service_endpoint, credential=get_credential(), transport=get_search_transport())
+
+SEARCH_SCOPE = "https://search.azure.com/.default"
+
+# Shared session: pooled keep-alive connections plus backoff retries for Search throttling (429/503)
+REQUEST_TIMEOUT = (5, 60)
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["PUT", "POST", "GET"],
+        # Hand the last response back instead of raising RetryError, so callers report the status
+        raise_on_status=False,
+    ),
+))
+
+_token_cache = {}
+_token_lock = threading.Lock()
+
+def get_cached_token(scope):
+    """Return a bearer token for scope, reusing the cached one until 5 minutes before expiry."""
+    with _token_lock:
+        token = _token_cache.get(scope)
+        if token is None or token.expires_on - 300 <= time.time():
+            token = get_credential().get_token(scope)
+            _token_cache[scope] = token
+        return token.token
+
+def create_data_source_via_rest(data_source_name, search_service_endpoint, token, storage_account_resource_id, container_name):
     url = f"{search_service_endpoint}/datasources/{data_source_name}?api-version=2024-07-01"
-    token = credential.get_token("https://search.azure.com/.default").token
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {token}"
@@ -35,175 +110,276 @@ def create_data_source_via_rest(data_source_name, search_service_endpoint, crede
             "name": container_name
         }
     }
-    response = requests.put(url, headers=headers, json=data_source_definition)
+    response = SESSION.put(url, headers=headers, data=orjson.dumps(data_source_definition), timeout=REQUEST_TIMEOUT)
+    # Returns (ok, message); the message is printed by the caller, not from worker threads
     if response.status_code in [200, 201]:
-        print(f"Created data source: {data_source_name}")
-        return True
+        return True, f"Created data source: {data_source_name}"
     elif response.status_code == 409:
-        print(f"Data source {data_source_name} already exists.")
-        return True
+        return True, f"Data source {data_source_name} already exists."
     else:
-        print(f"Error creating data source: {response.status_code} - {response.text}")
-        return False
+        return False, f"Error creating data source: {response.status_code} - {response.text}"
 
-def create_index_via_rest(index_name, search_service_endpoint, credential):
-    """Create index via REST API"""
-    url = f"{search_service_endpoint}/indexes/{index_name}?api-version=2024-07-01"
-    token = credential.get_token("https://search.azure.com/.default").token
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token}"
-    }
-    
-    index_definition = {
-        "name": index_name,
-        "fields": [
-            {
-                "name": "docid",
-                "type": "Edm.String",
-                "key": True,
-                "filterable": True,
-                "sortable": True,
-                "searchable": True,
-                "retrievable": True
-            },
-            {
-                "name": "content", 
-                "type": "Edm.String",
-                "searchable": True,
-                "filterable": False,
-                "sortable": False,
-                "facetable": False,
-                "retrievable": True,
-                "analyzer": "ja.lucene"
-            },
-            {
-                "name": "metadata_storage_name",
-                "type": "Edm.String", 
-                "filterable": True,
-                "sortable": True,
-                "searchable": True,
-                "retrievable": True
-            },
-            {
-                "name": "metadata_storage_path",
-                "type": "Edm.String",
-                "filterable": True,
-                "sortable": True,
-                "searchable": True,
-                "retrievable": True
-            },
-            {
-                "name": "embedding",
-                "type": "Collection(Edm.Single)",
-                "searchable": True,
-                "filterable": False,
-                "sortable": False,
-                "facetable": False,
-                "retrievable": True,
-                "dimensions": 1536,
-                "vectorSearchProfile": "default-vector-profile"
-            }
+def create_index(index_name):
+    """Create (or update) the search index via the SDK's pooled SearchIndexClient pipeline"""
+    index = SearchIndex(
+        name=index_name,
+        fields=[
+            SearchField(
+                name="docid",
+                type=SearchFieldDataType.String,
+                key=True,
+                filterable=True,
+                sortable=True,
+                searchable=True,
+            ),
+            SearchField(
+                name="content",
+                type=SearchFieldDataType.String,
+                searchable=True,
+                filterable=False,
+                sortable=False,
+                facetable=False,
+                analyzer_name="ja.lucene",
+            ),
+            SearchField(
+                name="source",
+                type=SearchFieldDataType.String,
+                filterable=True,
+                facetable=True,
+                searchable=False,
+            ),
+            SearchField(
+                name="metadata_storage_name",
+                type=SearchFieldDataType.String,
+                filterable=True,
+                sortable=True,
+                searchable=True,
+            ),
+            SearchField(
+                name="metadata_storage_path",
+                type=SearchFieldDataType.String,
+                filterable=True,
+                sortable=True,
+                searchable=True,
+            ),
+            SearchField(
+                name="embedding",
+                type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
+                searchable=True,
+                filterable=False,
+                sortable=False,
+                facetable=False,
+                vector_search_dimensions=1536,
+                vector_search_profile_name="default-vector-profile",
+            ),
         ],
-        "vectorSearch": {
-            "algorithms": [
-                {
-                    "name": "default-hnsw-algorithm",
-                    "kind": "hnsw",
-                    "hnswParameters": {
-                        "m": 4,
-                        "efConstruction": 400,
-                        "efSearch": 500,
-                        "metric": "cosine"
-                    }
-                }
+        vector_search=VectorSearch(
+            algorithms=[
+                HnswAlgorithmConfiguration(
+                    name="default-hnsw-algorithm",
+                    parameters=HnswParameters(
+                        m=4,
+                        ef_construction=200,
+                        ef_search=500,
+                        metric="cosine",
+                    ),
+                )
             ],
-            "profiles": [
-                {
-                    "name": "default-vector-profile",
-                    "algorithm": "default-hnsw-algorithm"
-                }
-            ]
-        },
-        "semantic": {
-            "configurations": [
-                {
-                    "name": f"{index_name}-semantic-configuration",
-                    "prioritizedFields": {
-                        "titleField": {
-                            "fieldName": "metadata_storage_name"
-                        },
-                        "prioritizedContentFields": [
-                            {
-                                "fieldName": "content"
-                            }
-                        ],
-                        "prioritizedKeywordsFields": [
-                            {
-                                "fieldName": "metadata_storage_path"
-                            }
-                        ]
-                    }
-                }
+            # int8 scalar quantization: ~4x less vector memory touched during graph build and search
+            compressions=[
+                ScalarQuantizationCompression(
+                    compression_name="sq",
+                    parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+                )
+            ],
+            profiles=[
+                VectorSearchProfile(
+                    name="default-vector-profile",
+                    algorithm_configuration_name="default-hnsw-algorithm",
+                    compression_name="sq",
+                )
+            ],
+        ),
+        semantic_search=SemanticSearch(
+            configurations=[
+                SemanticConfiguration(
+                    name=f"{index_name}-semantic-configuration",
+                    prioritized_fields=SemanticPrioritizedFields(
+                        title_field=SemanticField(field_name="metadata_storage_name"),
+                        content_fields=[SemanticField(field_name="content")],
+                        keywords_fields=[SemanticField(field_name="metadata_storage_path")],
+                    ),
+                )
             ]
-        }
-    }
-    
-    response = requests.put(url, headers=headers, json=index_definition)
-    if response.status_code in [200, 201]:
+        ),
+    )
+
+    try:
+        get_index_client().create_or_update_index(index)
         return True
-    else:
-        print(f"Error creating index: {response.status_code} - {response.text}")
+    except HttpResponseError as e:
+        print(f"Error creating index: {e.status_code} - {e.message}")
         return False
 
+async def trigger_all(indexer_names):
+    """POST run for every indexer concurrently over one aiohttp connection pool"""
+    headers = {"Authorization": f"Bearer {get_cached_token(SEARCH_SCOPE)}"}
+    connector = aiohttp.TCPConnector(limit=10, enable_cleanup_closed=True)
+    async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+        async def run(indexer_name):
+            url = f"{search_service_endpoint}/indexers/{indexer_name}/run?api-version=2024-07-01"
+            try:
+                async with session.post(url) as response:
+                    return indexer_name, response.status, await response.text()
+            except aiohttp.ClientError as e:
+                return indexer_name, None, str(e)
+
+        return await asyncio.gather(*(run(name) for name in indexer_names))
+
+# Adaptive indexer batch size, persisted between runs:
+# doubled after a clean run that filled a batch, halved after throttling / payload-too-large failures
+BATCH_SIZE_FILE = ".indexer_batch_size.json"
+DEFAULT_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 32000
+
+def load_batch_sizes():
+    """Load the per-indexer batch sizes recorded by the previous run"""
+    try:
+        with open(BATCH_SIZE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_batch_sizes(batch_sizes):
+    with open(BATCH_SIZE_FILE, "w", encoding="utf-8") as f:
+        json.dump(batch_sizes, f, indent=2)
+
+def tune_batch_size(indexer_name, batch_size):
+    """Adjust batch_size from the indexer's last execution result"""
+    try:
+        last_result = get_indexer_client().get_indexer_status(indexer_name).last_result
+    except ResourceNotFoundError:
+        return batch_size
+    if last_result is None:
+        return batch_size
+    throttled = last_result.status == "transientFailure" or any(
+        getattr(err, "status_code", None) in (413, 429, 503) for err in (last_result.errors or [])
+    )
+    if throttled:
+        return max(1, batch_size // 2)
+    # Only grow when the last run actually filled a batch of the current size
+    if last_result.status == "success" and not last_result.errors and (last_result.item_count or 0) >= batch_size:
+        return min(MAX_BATCH_SIZE, batch_size * 2)
+    return batch_size
+
 containers = [
     "inventories",
     "incidents"
 ]
 
-for container in containers:
+# Both containers feed one shared index; the `source` field tells their documents apart
+index_name = "index-ops"
+
+def _mapping_key(mapping):
+    function = mapping.mapping_function
+    return (
+        mapping.source_field_name,
+        mapping.target_field_name,
+        function.name if function else None,
+        tuple(sorted((function.parameters or {}).items())) if function else None,
+    )
+
+def indexer_definition_changed(existing, indexer):
+    """True when the deployed indexer writes to a different index or maps fields differently"""
+    if existing.target_index_name != indexer.target_index_name:
+        return True
+    return set(map(_mapping_key, existing.field_mappings or [])) != set(map(_mapping_key, indexer.field_mappings or []))
+
+def bootstrap_container(container):
+    """Create data source and indexer for one container and start indexing.
+
+    Messages are collected and returned instead of printed so that output from
+    containers bootstrapped in parallel does not interleave.
+    """
+    messages = []
+    token = get_cached_token(SEARCH_SCOPE)
+
     # 1. Create data source via REST API (User Assigned Managed Identity)
     data_source_name = f"ds-{container}"
     storage_account_resource_id = f"/subscriptions/{os.getenv('AZURE_SUBSCRIPTION_ID')}/resourceGroups/rg-{os.getenv('AZURE_ENV_NAME')}/providers/Microsoft.Storage/storageAccounts/{storage_account_name}"
-    if not create_data_source_via_rest(data_source_name, search_service_endpoint, credential, storage_account_resource_id, container):
-        print(f"Failed to create data source: {data_source_name}")
+    created, message = create_data_source_via_rest(data_source_name, search_service_endpoint, token, storage_account_resource_id, container)
+    messages.append(message)
+    if not created:
+        messages.append(f"Failed to create data source: {data_source_name}")
 
-    # 2. Create index
-    index_name = f"index-{container}"
-    index_created = False
-    try:
-        if create_index_via_rest(index_name, search_service_endpoint, credential):
-            print(f"Created index: {index_name}")
-            index_created = True
-        else:
-            print(f"Failed to create index: {index_name}")
-    except Exception as e:
-        print(f"Index {index_name} might already exist or error occurred: {e}")
-
-    if not index_created:
-        print(f"Skipping indexer creation for {container} due to index creation failure")
-
-    # 3. Create indexer
+    # 2. Create indexer targeting the shared index
     indexer_name = f"indexer-{container}"
-    try:
-        indexer = SearchIndexer(
-            name=indexer_name,
-            data_source_name=data_source_name,
-            target_index_name=index_name,
-            field_mappings=[
-                FieldMapping(source_field_name="metadata_storage_name", target_field_name="metadata_storage_name"),
-                FieldMapping(source_field_name="metadata_storage_path", target_field_name="metadata_storage_path"),
-                FieldMapping(source_field_name="docid", target_field_name="docid"),
-                FieldMapping(source_field_name="content", target_field_name="content"),
-            ]
-        )
-        indexer_client.create_indexer(indexer)
-        print(f"Created indexer: {indexer_name}")
-    except ResourceExistsError:
-        print(f"Indexer {indexer_name} already exists.")
+    # Only an existing indexer has a previous run to tune from
+    batch_size = batch_sizes.get(indexer_name, DEFAULT_BATCH_SIZE)
+    if indexer_name in existing_indexers:
+        batch_size = tune_batch_size(indexer_name, batch_size)
+    indexer = SearchIndexer(
+        name=indexer_name,
+        data_source_name=data_source_name,
+        target_index_name=index_name,
+        parameters=IndexingParameters(batch_size=batch_size),
+        field_mappings=[
+            FieldMapping(source_field_name="metadata_storage_name", target_field_name="metadata_storage_name"),
+            FieldMapping(source_field_name="metadata_storage_path", target_field_name="metadata_storage_path"),
+            # https://<account>.blob.core.windows.net/<container>/<blob> -> <container>
+            FieldMapping(
+                source_field_name="metadata_storage_path",
+                target_field_name="source",
+                mapping_function=FieldMappingFunction(
+                    name="extractTokenAtPosition",
+                    parameters={"delimiter": "/", "position": 3},
+                ),
+            ),
+            FieldMapping(source_field_name="docid", target_field_name="docid"),
+            FieldMapping(source_field_name="content", target_field_name="content"),
+        ]
+    )
+    if indexer_name in existing_indexers:
+        # A changed target index or mapping needs a full re-crawl: without a reset the blob
+        # high-water mark skips everything indexed before, leaving the new target empty
+        needs_reset = indexer_definition_changed(get_indexer_client().get_indexer(indexer_name), indexer)
+        # Update so the existing indexer picks up the tuned batch size
+        get_indexer_client().create_or_update_indexer(indexer)
+        messages.append(f"Updated indexer: {indexer_name} (batch_size={batch_size})")
+        if needs_reset:
+            get_indexer_client().reset_indexer(indexer_name)
+            messages.append(f"Reset indexer: {indexer_name} (target index or field mappings changed)")
+    else:
+        get_indexer_client().create_indexer(indexer)
+        messages.append(f"Created indexer: {indexer_name} (batch_size={batch_size})")
 
-    indexer_client.run_indexer(indexer_name)
-    print(f"Started indexing for: {indexer_name}")
+    return {"container": container, "indexer_name": indexer_name, "batch_size": batch_size, "messages": messages}
+
+batch_sizes = load_batch_sizes()
+# One listing up front instead of a create attempt (and 409) per container
+existing_indexers = set(get_indexer_client().get_indexer_names())
+
+# Create the shared index once before any indexer points at it
+if create_index(index_name):
+    print(f"Created index: {index_name}")
+else:
+    print(f"Failed to create index: {index_name}")
+
+# Containers are independent, so bootstrap them concurrently (network-bound work)
+with ThreadPoolExecutor(max_workers=len(containers)) as executor:
+    results = list(executor.map(bootstrap_container, containers))
+
+for result in results:
+    for message in result["messages"]:
+        print(message)
+
+# Indexers run server-side, so just fire all run requests together
+for indexer_name, status, detail in asyncio.run(trigger_all([r["indexer_name"] for r in results])):
+    if status == 202:
+        print(f"Started indexing for: {indexer_name}")
+    else:
+        print(f"Error starting indexer {indexer_name}: {status} - {detail}")
 
-print("Created indices and started indexing for all containers.")
+save_batch_sizes({**batch_sizes, **{r["indexer_name"]: r["batch_size"] for r in results}})
 
+print("Created index and started indexing for all containers.")
@@ -5,89 +5,139 @@ This script replaces the PowerShell Ensure-DbUser function with a Python impleme
 that uses Authentication=ActiveDirectoryDefault for reliable Azure CLI token-based authentication.
 """
 
+import functools
+import mmap
 import os
+import re
 import sys
+import threading
+import time
 import argparse
 import logging
-import subprocess
-from pathlib import Path
-from typing import Dict
+from typing import TYPE_CHECKING, Dict, Tuple
 import struct
-from azure.identity import DefaultAzureCredential
 
-import pyodbc
-from azure.core.exceptions import ClientAuthenticationError
+# pyodbc and azure.* are imported on first use so --help and argument validation stay fast
+if TYPE_CHECKING:
+    import pyodbc
+    from azure.identity import DefaultAzureCredential
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+SQL_SCOPE = "https://database.windows.net/.default"
 
-def load_env_file(env_path: str = ".env") -> Dict[str, str]:
-    """Load environment variables from .env file."""
-    env_vars = {}
-    env_file = Path(env_path)
-    
-    if not env_file.exists():
-        logger.warning(f"Environment file {env_path} not found")
-        return env_vars
-    
-    with open(env_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#') and '=' in line:
-                key, value = line.split('=', 1)
-                env_vars[key.strip()] = value.strip().strip('"').strip("'")
-    
-    return env_vars
+# (tenant, scope) -> (UTF-16-LE token bytes, expires_on)
+_TOKEN_CACHE: Dict[Tuple[str, str], Tuple[bytes, int]] = {}
+_TOKEN_LOCK = threading.Lock()
 
-def build_user_creation_sql(app_name: str) -> str:
-    """
-    Build T-SQL for creating user and assigning roles.
-    
-    Args:
-        app_name: App Service name or Service Principal Object ID
-        is_service_principal: Whether the principal is a Service Principal
-    
-    Returns:
-        T-SQL command string
-    """
-    # Escape SQL identifier
-    escaped_name = app_name.replace(']', ']]')
-    identifier = f"[{escaped_name}]"
-    
-    principal_type = "App Service Managed Identity"
-    
-    # Use RAISERROR with severity 10 for informational messages that can be captured
-    sql = f"""-- Create {principal_type} user: {app_name}
-IF NOT EXISTS (SELECT 1 FROM sys.database_principals WHERE name = N'{app_name}')
+# connection string -> open connection, reused across ensure_db_user calls in one process
+_CONN_CACHE: Dict[str, "pyodbc.Connection"] = {}
+
+# (server, database, principal) already confirmed as user + db_datareader member in this process
+_USER_STATE_CACHE: Dict[Tuple[str, str, str], bool] = {}
+
+# Newest first; Driver 18 is the only one that speaks TDS 8 (Encrypt=strict)
+SUPPORTED_ODBC_DRIVERS = ("ODBC Driver 18 for SQL Server", "ODBC Driver 17 for SQL Server")
+
+# KEY=value / KEY="value" / KEY='value' lines; comments and blank lines never match
+ENV_LINE_PATTERN = re.compile(rb'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*["\']?(.*?)["\']?[ \t]*\r?$', re.MULTILINE)
+
+
+# Use RAISERROR with severity 10 for informational messages that can be captured.
+# The principal name is the only parameter: identical text for every principal lets SQL Server
+# reuse the cached plan, and QUOTENAME does the identifier escaping server-side.
+USER_CREATION_SQL = """-- Create App Service Managed Identity user
+SET NOCOUNT ON;
+DECLARE @name sysname = ?;
+DECLARE @sql nvarchar(max);
+
+IF NOT EXISTS (SELECT 1 FROM sys.database_principals WHERE name = @name)
 BEGIN
-    CREATE USER {identifier} FROM EXTERNAL PROVIDER;
-    RAISERROR('Created user: {app_name}', 10, 1) WITH NOWAIT;
+    SET @sql = N'CREATE USER ' + QUOTENAME(@name) + N' FROM EXTERNAL PROVIDER';
+    EXEC sp_executesql @sql;
+    RAISERROR('Created user: %s', 10, 1, @name) WITH NOWAIT;
 END
 ELSE
 BEGIN
-    RAISERROR('User already exists: {app_name}', 10, 1) WITH NOWAIT;
+    RAISERROR('User already exists: %s', 10, 1, @name) WITH NOWAIT;
 END;
 
 IF NOT EXISTS (
     SELECT 1 FROM sys.database_role_members rm
     JOIN sys.database_principals r ON rm.role_principal_id = r.principal_id
     JOIN sys.database_principals m ON rm.member_principal_id = m.principal_id
-    WHERE r.name = N'db_datareader' AND m.name = N'{app_name}'
+    WHERE r.name = N'db_datareader' AND m.name = @name
 )
 BEGIN
-    ALTER ROLE db_datareader ADD MEMBER {identifier};
-    RAISERROR('Added to db_datareader: {app_name}', 10, 1) WITH NOWAIT;
+    SET @sql = N'ALTER ROLE db_datareader ADD MEMBER ' + QUOTENAME(@name);
+    EXEC sp_executesql @sql;
+    RAISERROR('Added to db_datareader: %s', 10, 1, @name) WITH NOWAIT;
 END
 ELSE
 BEGIN
-    RAISERROR('Already member of db_datareader: {app_name}', 10, 1) WITH NOWAIT;
+    RAISERROR('Already member of db_datareader: %s', 10, 1, @name) WITH NOWAIT;
 END;"""
-    
-    return sql
 
 
+# Read-only probe: when both flags are 1 the DDL batch below has nothing to do
+USER_STATE_SQL = """SELECT
+    CASE WHEN EXISTS (SELECT 1 FROM sys.database_principals WHERE name = ?) THEN 1 ELSE 0 END AS has_user,
+    CASE WHEN EXISTS (
+        SELECT 1 FROM sys.database_role_members rm
+        JOIN sys.database_principals r ON rm.role_principal_id = r.principal_id
+        JOIN sys.database_principals m ON rm.member_principal_id = m.principal_id
+        WHERE r.name = N'db_datareader' AND m.name = ?
+    ) THEN 1 ELSE 0 END AS has_role;"""
+
+
+@functools.lru_cache(maxsize=8)
+def _load_env_file_cached(abs_path: str, mtime_ns: int) -> Dict[str, str]:
+    """Parse an .env file; mtime_ns is only part of the cache key so edits invalidate it."""
+    # Match on the raw bytes of a read-only mapping; only the matched pairs are decoded
+    with open(abs_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {}  # mmap cannot map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return {key.decode('ascii'): value.decode('utf-8') for key, value in ENV_LINE_PATTERN.findall(mm)}
+
+def load_env_file(env_path: str = ".env") -> Dict[str, str]:
+    """Load environment variables from .env file."""
+    abs_path = os.path.abspath(env_path)
+    try:
+        mtime_ns = os.stat(abs_path).st_mtime_ns
+    except FileNotFoundError:
+        logger.warning("Environment file %s not found", env_path)
+        return {}
+    # Copy so callers cannot mutate the cached mapping
+    return dict(_load_env_file_cached(abs_path, mtime_ns))
+
+def log_sql_messages(cursor) -> None:
+    """Log informational / warning messages (PRINT, RAISERROR) attached to the current result set."""
+    if hasattr(cursor, 'messages') and cursor.messages:
+        for message in cursor.messages:
+            if isinstance(message, tuple) and len(message) >= 3:
+                sql_state, error_code, msg_text = message[0], message[1], message[2]
+                if sql_state == '01000' or error_code == 0 or str(error_code).startswith('5001'):  # Informational or RAISERROR
+                    logger.info("SQL Message: %s", msg_text)
+                else:
+                    logger.warning("SQL Warning [%s][%s]: %s", sql_state, error_code, msg_text)
+            else:
+                logger.info("SQL Message: %s", message)
+        cursor.messages.clear()
+
+
+@functools.cache
+def get_odbc_driver() -> str:
+    """Pick the newest installed SQL Server ODBC driver (resolved once per process)."""
+    installed = set(_pyodbc().drivers())
+    driver = next((d for d in SUPPORTED_ODBC_DRIVERS if d in installed), None)
+    if driver is None:
+        raise RuntimeError(f"No supported ODBC driver found; install one of {SUPPORTED_ODBC_DRIVERS} (installed: {sorted(installed)})")
+    logger.debug("Using ODBC driver: %s", driver)
+    return driver
+
 def get_sql_connection_string(server: str, database: str) -> str:
     """
     Build SQL connection string for Azure SQL Server.
@@ -95,38 +145,80 @@ def get_sql_connection_string(server: str, database: str) -> str:
     Args:
         server: SQL Server name
         database: Database name
-        access_token: Entra ID access token
     
     Returns:
         Connection string
     """
-    # Enhanced connection string for better compatibility
+    # Pin TCP on 1433 (no named-pipes attempt) and TDS 8 strict encryption; MARS is not needed
+    driver = get_odbc_driver()
+    encrypt = "strict" if driver == SUPPORTED_ODBC_DRIVERS[0] else "yes"
+    server = server.replace("tcp:", "")
     conn_string = (
-        f"DRIVER={{ODBC Driver 18 for SQL Server}};"
-        f"SERVER={server};"
+        f"DRIVER={{{driver}}};"
+        f"SERVER=tcp:{server},1433;"
         f"DATABASE={database};"
-        f"Encrypt=yes;"
+        f"Encrypt={encrypt};"
         f"TrustServerCertificate=no;"
+        f"MARS_Connection=no;"
         f"Connection Timeout=30;"
         f"Command Timeout=30;"
         f"LoginTimeout=30;"
+        f"APP=ensure_db_user;"
     )
     return conn_string
 
+@functools.cache
+def _pyodbc():
+    """Import pyodbc once, enabling process-level ODBC pooling before the first connect()."""
+    import pyodbc
+    pyodbc.pooling = True
+    return pyodbc
+
+@functools.cache
+def get_credential() -> "DefaultAzureCredential":
+    """Single in-process credential shared by every token request."""
+    from azure.identity import DefaultAzureCredential
+    return DefaultAzureCredential(exclude_interactive_browser_credential=True)
+
+def get_sql_token_bytes() -> bytes:
+    """
+    Return the UTF-16-LE encoded Azure SQL access token, reusing a cached one
+    until it is within 5 minutes of expiry (same refresh skew as azure-identity).
+    """
+    key = (os.getenv("AZURE_TENANT_ID", ""), SQL_SCOPE)
+    with _TOKEN_LOCK:
+        cached = _TOKEN_CACHE.get(key)
+        if cached and cached[1] - time.time() > 300:
+            return cached[0]
+        token = get_credential().get_token(SQL_SCOPE)
+        token_bytes = token.token.encode("UTF-16-LE")
+        _TOKEN_CACHE[key] = (token_bytes, token.expires_on)
+        return token_bytes
+
 def get_conn(connection_string):
     """
     Get database connection using appropriate Azure credentials.
     Uses Azure CLI in development/CI, Managed Identity in production App Service.
     """
+    pyodbc = _pyodbc()
+    conn = _CONN_CACHE.get(connection_string)
+    if conn is not None:
+        try:
+            conn.cursor().execute("SELECT 1").fetchone()
+            return conn
+        except pyodbc.Error:
+            # Dropped by the server or the network; fall through and reconnect
+            _CONN_CACHE.pop(connection_string, None)
+
     try:
-        credential = DefaultAzureCredential()
-        token_bytes = credential.get_token("https://database.windows.net/.default").token.encode("UTF-16-LE")
+        token_bytes = get_sql_token_bytes()
         token_struct = struct.pack(f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
         SQL_COPT_SS_ACCESS_TOKEN = 1256  # This connection option is defined by microsoft in msodbcsql.h
         conn = pyodbc.connect(connection_string, attrs_before={SQL_COPT_SS_ACCESS_TOKEN: token_struct})
+        _CONN_CACHE[connection_string] = conn
         return conn
     except Exception as e:
-        logger.error(f"Azure credential failed: {e}")
+        logger.error("Azure credential failed: %s", e)
         raise
 
 def ensure_db_user(server: str, database: str, app_name: str) -> bool:
@@ -137,112 +229,92 @@ def ensure_db_user(server: str, database: str, app_name: str) -> bool:
         server: SQL Server name  
         database: Database name
         app_name: App Service name or Service Principal Object ID
-        is_service_principal: Whether the principal is a Service Principal
     
     Returns:
         True if successful, False otherwise
     """
+    pyodbc = _pyodbc()
+    from azure.core.exceptions import ClientAuthenticationError
+
+    state_key = (server, database, app_name)
+    if _USER_STATE_CACHE.get(state_key):
+        logger.info("Database user already ensured for: %s", app_name)
+        return True
+
     try:
-        logger.info(f"Creating database user for: {app_name}")
+        logger.info("Creating database user for: %s", app_name)
 
         # Build connection string
         conn_string = get_sql_connection_string(server, database)  # Token not needed here
-        logger.info(f"  Connecting to: {server}/{database}")
-        
-        # Build SQL command
-        sql_command = build_user_creation_sql(app_name)
+        logger.info("  Connecting to: %s/%s", server, database)
         
         # Enhanced connection attempt with better error handling
         try:
             with get_conn(conn_string) as conn:
                 logger.debug("Successfully connected to database")
+                # The probe is a read-only SELECT and the batch is idempotent DDL, so let each
+                # statement commit itself and skip the separate COMMIT round-trip. Set it before
+                # any statement runs so no result set is pending when the attribute changes
+                conn.autocommit = True
                 cursor = conn.cursor()
 
-                # Enable SQL Server message handling
-                conn.autocommit = False
-                
-                # Execute SQL in parts to handle PRINT statements
-                for statement in sql_command.split('\n\n'):
-                    if statement.strip():
-                        try:
-                            # -----message handling------
-                            try:    
-                                cursor.execute(statement)
-
-                                if hasattr(cursor, 'messages') and cursor.messages:
-                                    for message in cursor.messages:
-                                        if isinstance(message, tuple) and len(message) >= 3:
-                                            sql_state, error_code, msg_text = message[0], message[1], message[2]
-                                            if sql_state == '01000' or error_code == 0 or str(error_code).startswith('5001'):  # Informational or RAISERROR
-                                                logger.info(f"SQL Message: {msg_text}")
-                                            else:
-                                                logger.warning(f"SQL Warning [{sql_state}][{error_code}]: {msg_text}")
-                                        else:
-                                            logger.info(f"SQL Message: {message}")
-                                    cursor.messages.clear()
-                            except pyodbc.Error as e:
-                                logger.error(f"SQL execution error: {e}")
-                                # Check for any remaining messages even on error
-                                if hasattr(cursor, 'messages') and cursor.messages:
-                                    for message in cursor.messages:
-                                        logger.error(f"SQL Error Message: {message}")
-                                
-                                # For RAISERROR messages, they might be in the exception itself
-                                error_msg = str(e)
-                                if 'Created user:' in error_msg or 'User already exists:' in error_msg or 'Added to db_datareader:' in error_msg or 'Already member of db_datareader:' in error_msg:
-                                    # Extract informational messages from the exception
-                                    lines = error_msg.split('\n')
-                                    for line in lines:
-                                        line = line.strip()
-                                        if any(keyword in line for keyword in ['Created user:', 'User already exists:', 'Added to db_datareader:', 'Already member of db_datareader:']):
-                                            logger.info(f"SQL Info (from exception): {line}")
-                                else:
-                                    raise
-                            # -----------------------------
-                        
-                            while cursor.nextset():
-                                pass
-                        except pyodbc.Error as e:
-                            # Check if it's just an informational message
-                            if "PRINT" not in statement:
-                                logger.error(f"SQL execution error: {e}")
-                                raise
+                has_user, has_role = cursor.execute(USER_STATE_SQL, app_name, app_name).fetchone()
+                if has_user and has_role:
+                    logger.info("User already exists with db_datareader: %s", app_name)
+                    _USER_STATE_CACHE[state_key] = True
+                    return True
+
+                # Submit the whole T-SQL script in a single round-trip
+                try:
+                    cursor.execute(USER_CREATION_SQL, app_name)
+                    log_sql_messages(cursor)
+                    # RAISERROR output arrives per result set, so log while draining. The drain
+                    # must stay: errors from later statements in the batch only surface here
+                    while cursor.nextset():
+                        log_sql_messages(cursor)
+                except pyodbc.Error as e:
+                    logger.error("SQL execution error: %s", e)
+                    # Check for any remaining messages even on error
+                    if hasattr(cursor, 'messages') and cursor.messages:
+                        for message in cursor.messages:
+                            logger.error("SQL Error Message: %s", message)
+
+                    # For RAISERROR messages, they might be in the exception itself
+                    error_msg = str(e)
+                    if 'Created user:' in error_msg or 'User already exists:' in error_msg or 'Added to db_datareader:' in error_msg or 'Already member of db_datareader:' in error_msg:
+                        # Extract informational messages from the exception
+                        lines = error_msg.split('\n')
+                        for line in lines:
+                            line = line.strip()
+                            if any(keyword in line for keyword in ['Created user:', 'User already exists:', 'Added to db_datareader:', 'Already member of db_datareader:']):
+                                logger.info("SQL Info (from exception): %s", line)
+                    else:
+                        raise
                 
-                conn.commit()
                 logger.info("Database user creation completed successfully")
+                _USER_STATE_CACHE[state_key] = True
                 return True
         except pyodbc.Error as conn_error:
-            logger.error(f"Database connection error: {conn_error}")
-            logger.error(f"Error code: {getattr(conn_error, 'args', 'N/A')}")
-            
-            # Additional diagnostics
-            try:
-                drivers = [d for d in pyodbc.drivers() if 'SQL Server' in d]
-                logger.info(f"Available ODBC drivers: {drivers}")
-            except Exception as driver_error:
-                logger.error(f"Could not list ODBC drivers: {driver_error}")
-            
+            logger.error("Database connection error: %s", conn_error)
+            logger.error("Error code: %s", getattr(conn_error, 'args', 'N/A'))
+            logger.info("ODBC driver: %s", get_odbc_driver())
             raise
             
     except ClientAuthenticationError as e:
-        logger.error(f"Azure authentication failed: {e}")
+        logger.error("Azure authentication failed: %s", e)
         logger.error("Make sure you are logged in with 'az login' and have proper permissions")
         return False
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Azure CLI error: {e}")
-        logger.error("Make sure Azure CLI is installed and you are logged in with 'az login'")
-        return False
     except pyodbc.Error as e:
-        logger.error(f"SQL Server error: {e}")
+        logger.error("SQL Server error: %s", e)
         # More detailed error information
         if hasattr(e, 'args') and len(e.args) > 1:
-            logger.error(f"Error details: {e.args}")
+            logger.error("Error details: %s", e.args)
         return False
     except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        logger.error(f"Error type: {type(e).__name__}")
+        logger.error("Unexpected error: %s", e)
+        logger.error("Error type: %s", type(e).__name__)
         import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+        logger.error("Traceback: %s", traceback.format_exc())
         return False
 
 
@@ -5,13 +5,21 @@ import os
 from dotenv import load_dotenv
 import sys
 import datetime as dt
+import functools
+import itertools
 import struct
+import time
 from pathlib import Path
-from typing import Any, Iterable
+from typing import Any, Iterable, Iterator
 
+import ijson
+import orjson
 import pyodbc  # type: ignore
 from azure.identity import DefaultAzureCredential
 
+# Process-level ODBC connection pooling; must be set before the first pyodbc.connect()
+pyodbc.pooling = True
+
 ROOT = Path(__file__).resolve().parents[1]
 ARC_DIR = ROOT / "sample-data" / "arc"
 
@@ -21,8 +29,87 @@ SW_FILE = ARC_DIR / "logana_get_install_software.json"
 
 SCOPE = "https://database.windows.net/.default"
 
+# Rows per executemany call; keeps fast_executemany parameter buffers bounded
+EXECUTEMANY_CHUNK_SIZE = 1000
+
+# MERGE probes the primary key once per row instead of IF EXISTS + UPDATE/INSERT
+VM_UPSERT_SQL = """
+MERGE dbo.virtual_machines WITH (HOLDLOCK) AS tgt
+USING (VALUES (
+	?, ?, TRY_CONVERT(uniqueidentifier, ?), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, TRY_CONVERT(uniqueidentifier, ?)
+)) AS src (
+	resource_id,name,subscription_id,resource_group,location,vm_size,os_type,os_name,os_version,
+	provisioning_state,priority,time_created,power_state,admin_username,server_type_tag,tags_json,identity_principal_id
+)
+ON tgt.resource_id = src.resource_id
+WHEN MATCHED THEN UPDATE SET
+	name=src.name, subscription_id=src.subscription_id, resource_group=src.resource_group, location=src.location,
+	vm_size=src.vm_size, os_type=src.os_type, os_name=src.os_name, os_version=src.os_version,
+	provisioning_state=src.provisioning_state, priority=src.priority, time_created=src.time_created,
+	power_state=src.power_state, admin_username=src.admin_username, server_type_tag=src.server_type_tag,
+	tags_json=src.tags_json, identity_principal_id=src.identity_principal_id
+WHEN NOT MATCHED THEN INSERT (
+	resource_id,name,subscription_id,resource_group,location,vm_size,os_type,os_name,os_version,
+	provisioning_state,priority,time_created,power_state,admin_username,server_type_tag,tags_json,identity_principal_id
+) VALUES (
+	src.resource_id, src.name, src.subscription_id, src.resource_group, src.location, src.vm_size, src.os_type,
+	src.os_name, src.os_version, src.provisioning_state, src.priority, src.time_created, src.power_state,
+	src.admin_username, src.server_type_tag, src.tags_json, src.identity_principal_id
+);
+"""
+
+NIC_UPSERT_SQL = """
+MERGE dbo.network_interfaces WITH (HOLDLOCK) AS tgt
+USING (VALUES (?, ?, TRY_CONVERT(uniqueidentifier, ?), ?, ?, ?, ?, ?, ?, ?, ?)) AS src (
+	resource_id,name,subscription_id,resource_group,location,mac_address,private_ip,allocation_method,accelerated,primary_flag,vm_resource_id
+)
+ON tgt.resource_id = src.resource_id
+WHEN MATCHED THEN UPDATE SET
+	name=src.name, subscription_id=src.subscription_id, resource_group=src.resource_group, location=src.location,
+	mac_address=src.mac_address, private_ip=src.private_ip, allocation_method=src.allocation_method,
+	accelerated=src.accelerated, primary_flag=src.primary_flag, vm_resource_id=src.vm_resource_id
+WHEN NOT MATCHED THEN INSERT (
+	resource_id,name,subscription_id,resource_group,location,mac_address,private_ip,allocation_method,accelerated,primary_flag,vm_resource_id
+) VALUES (
+	src.resource_id, src.name, src.subscription_id, src.resource_group, src.location, src.mac_address,
+	src.private_ip, src.allocation_method, src.accelerated, src.primary_flag, src.vm_resource_id
+);
+"""
+
+SW_STAGE_DDL = """
+DROP TABLE IF EXISTS #stage_sw;
+CREATE TABLE #stage_sw (
+	seq             INT IDENTITY(1,1) PRIMARY KEY,
+	computer_name   NVARCHAR(256) NOT NULL,
+	software_name   NVARCHAR(512) NOT NULL,
+	current_version NVARCHAR(256),
+	publisher       NVARCHAR(512)
+);
+"""
+
+# Same duplicate rule as before (computer, software, version): skip rows already in the table,
+# and within the file keep only the first occurrence
+SW_INSERT_NEW_SQL = """
+INSERT INTO dbo.installed_software (computer_name,software_name,current_version,publisher)
+SELECT s.computer_name, s.software_name, s.current_version, s.publisher
+FROM (
+	SELECT *, ROW_NUMBER() OVER (
+		PARTITION BY computer_name, software_name, ISNULL(current_version,'') ORDER BY seq
+	) AS rn
+	FROM #stage_sw
+) AS s
+WHERE s.rn = 1 AND NOT EXISTS (
+	SELECT 1 FROM dbo.installed_software t
+	WHERE t.computer_name = s.computer_name AND t.software_name = s.software_name
+		AND ISNULL(t.current_version,'') = ISNULL(s.current_version,'')
+);
+"""
+
 load_dotenv()
 
+# (UTF-16-LE token bytes, expires_on) for SCOPE, refreshed shortly before expiry
+_sql_token: tuple[bytes, int] | None = None
+
 def env(name: str, default: str | None = None) -> str:
 	v = os.getenv(name, default)
 	if not v:
@@ -30,6 +117,30 @@ def env(name: str, default: str | None = None) -> str:
 	return v
 
 
+@functools.cache
+def get_odbc_driver() -> str:
+	"""Newest installed SQL Server ODBC driver, looked up once per process."""
+	installed = pyodbc.drivers()
+	for driver in ("ODBC Driver 18 for SQL Server", "ODBC Driver 17 for SQL Server"):
+		if driver in installed:
+			return driver
+	raise RuntimeError(f"No SQL Server ODBC driver (17 or 18) found; installed: {installed}")
+
+
+@functools.cache
+def get_credential() -> DefaultAzureCredential:
+	return DefaultAzureCredential(exclude_interactive_browser_credential=False)
+
+
+def get_sql_token_bytes() -> bytes:
+	"""Return the Azure SQL access token, reusing it until it is within 5 minutes of expiry."""
+	global _sql_token
+	if _sql_token is None or _sql_token[1] - time.time() < 300:
+		token = get_credential().get_token(SCOPE)
+		_sql_token = (token.token.encode("utf-16-le"), token.expires_on)
+	return _sql_token[0]
+
+
 def get_connection() -> pyodbc.Connection:
 	"""
 	Obtain an Azure SQL connection using an AAD access token.
@@ -42,16 +153,13 @@ def get_connection() -> pyodbc.Connection:
 	# Normalize server (allow user to omit tcp: prefix)
 	server = server.replace("tcp:", "")
 
-	credential = DefaultAzureCredential(exclude_interactive_browser_credential=False)
-	token = credential.get_token(SCOPE)
-
 	# Build token structure: 4-byte length (little endian) + UTF-16-LE token bytes
-	token_bytes = token.token.encode("utf-16-le")
+	token_bytes = get_sql_token_bytes()
 	token_struct = struct.pack("=i", len(token_bytes)) + token_bytes
 	attrs_before = {1256: token_struct}  # 1256 = SQL_COPT_SS_ACCESS_TOKEN
 
 	conn_str = (
-		"DRIVER={ODBC Driver 18 for SQL Server};"
+		f"DRIVER={{{get_odbc_driver()}}};"
 		f"SERVER=tcp:{server},1433;DATABASE={database};Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;"
 	)
 
@@ -133,151 +241,102 @@ def load_json_array(path: Path) -> list[dict[str, Any]]:
 		return json.load(f)
 
 
+def iter_json_array(path: Path) -> Iterator[dict[str, Any]]:
+	"""Yield the elements of a top-level JSON array one at a time without loading the whole file."""
+	if not path.exists():
+		print(f"WARN: {path} does not exist", file=sys.stderr)
+		return
+	with path.open("rb") as f:
+		yield from ijson.items(f, "item")
+
+
+def executemany_chunked(cursor: pyodbc.Cursor, sql: str, params: list[tuple[Any, ...]], chunk_size: int = EXECUTEMANY_CHUNK_SIZE) -> None:
+	"""Send parameter rows in fixed-size executemany batches (bounds fast_executemany buffers)."""
+	for start in range(0, len(params), chunk_size):
+		cursor.executemany(sql, params[start:start + chunk_size])
+
+
+def vm_params(row: dict[str, Any]) -> tuple[Any, ...]:
+	"""Column values for one VM in dbo.virtual_machines order; every lookup is done exactly once."""
+	props = row.get("properties") or {}
+	instance_view = (props.get("extended") or {}).get("instanceView") or {}
+	os_disk = (props.get("storageProfile") or {}).get("osDisk") or {}
+	os_type = os_disk.get("osType")
+	# fallback
+	os_name = instance_view.get("computerName") and instance_view.get("osName") or os_type
+	tags = row.get("tags") or {}
+	return (
+		row.get("id"),
+		row.get("name"),
+		row.get("subscriptionId"),
+		row.get("resourceGroup"),
+		row.get("location"),
+		(props.get("hardwareProfile") or {}).get("vmSize"),
+		os_type,
+		os_name,
+		instance_view.get("osVersion"),
+		props.get("provisioningState"),
+		props.get("priority"),
+		parse_time(props.get("timeCreated")),
+		(instance_view.get("powerState") or {}).get("displayStatus"),
+		(props.get("osProfile") or {}).get("adminUsername"),
+		tags.get("ServerType"),
+		orjson.dumps(tags).decode() if tags else None,
+		(row.get("identity") or {}).get("principalId"),
+	)
+
+
 def upsert_virtual_machines(cursor: pyodbc.Cursor, rows: Iterable[dict[str, Any]]) -> int:
-	count = 0
-	for row in rows:
-		props = row.get("properties", {})
-		ext = props.get("extended", {})
-		instance_view = ext.get("instanceView", {})
-		storage_profile = props.get("storageProfile", {})
-		os_disk = storage_profile.get("osDisk", {})
-		power_state = instance_view.get("powerState", {}).get("displayStatus")
-		os_name = instance_view.get("computerName") and instance_view.get("osName") or None
-		os_version = instance_view.get("osVersion")
-		# fallback
-		if not os_name:
-			os_name = os_disk.get("osType")
-		identity = row.get("identity") or {}
-		tags = row.get("tags") or {}
-		server_type_tag = None
-		if tags:
-			server_type_tag = tags.get("ServerType")
-
-		cursor.execute(
-			"""
-IF EXISTS (SELECT 1 FROM dbo.virtual_machines WHERE resource_id = ?)
-	UPDATE dbo.virtual_machines SET
-		name=?, subscription_id=TRY_CONVERT(uniqueidentifier, ?), resource_group=?, location=?,
-		vm_size=?, os_type=?, os_name=?, os_version=?, provisioning_state=?, priority=?,
-		time_created=?, power_state=?, admin_username=?, server_type_tag=?, tags_json=?, identity_principal_id=TRY_CONVERT(uniqueidentifier, ?)
-	WHERE resource_id=?
-ELSE
-	INSERT INTO dbo.virtual_machines (
-		resource_id,name,subscription_id,resource_group,location,vm_size,os_type,os_name,os_version,
-		provisioning_state,priority,time_created,power_state,admin_username,server_type_tag,tags_json,identity_principal_id
-	) VALUES (
-		?, ?, TRY_CONVERT(uniqueidentifier, ?), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, TRY_CONVERT(uniqueidentifier, ?)
-	);
-""",
-			row.get("id"),  # for UPDATE match
-			row.get("name"),
-			row.get("subscriptionId"),
-			row.get("resourceGroup"),
-			row.get("location"),
-			(props.get("hardwareProfile") or {}).get("vmSize"),
-			os_disk.get("osType"),
-			os_name,
-			os_version,
-			props.get("provisioningState"),
-			props.get("priority"),
-			parse_time(props.get("timeCreated")),
-			power_state,
-			(props.get("osProfile") or {}).get("adminUsername"),
-			server_type_tag,
-			json.dumps(tags, ensure_ascii=False) if tags else None,
-			identity.get("principalId"),
-			row.get("id"),  # WHERE resource_id
-			# INSERT values (repeat in order)
-			row.get("id"),
-			row.get("name"),
-			row.get("subscriptionId"),
-			row.get("resourceGroup"),
-			row.get("location"),
-			(props.get("hardwareProfile") or {}).get("vmSize"),
-			os_disk.get("osType"),
-			os_name,
-			os_version,
-			props.get("provisioningState"),
-			props.get("priority"),
-			parse_time(props.get("timeCreated")),
-			power_state,
-			(props.get("osProfile") or {}).get("adminUsername"),
-			server_type_tag,
-			json.dumps(tags, ensure_ascii=False) if tags else None,
-			identity.get("principalId"),
-		)
-		count += 1
-	return count
+	params = [vm_params(row) for row in rows]
+	executemany_chunked(cursor, VM_UPSERT_SQL, params)
+	return len(params)
+
+
+def nic_params(row: dict[str, Any]) -> tuple[Any, ...]:
+	"""Column values for one NIC in dbo.network_interfaces order."""
+	props = row.get("properties") or {}
+	ip_configs = props.get("ipConfigurations") or []
+	ip_props = (ip_configs[0] if ip_configs else {}).get("properties") or {}
+	return (
+		row.get("id"),
+		row.get("name"),
+		row.get("subscriptionId"),
+		row.get("resourceGroup"),
+		row.get("location"),
+		props.get("macAddress"),
+		ip_props.get("privateIPAddress"),
+		ip_props.get("privateIPAllocationMethod"),
+		1 if props.get("enableAcceleratedNetworking") else 0,
+		1 if (props.get("primary") or ip_props.get("primary")) else 0,
+		(props.get("virtualMachine") or {}).get("id"),
+	)
 
 
 def upsert_network_interfaces(cursor: pyodbc.Cursor, rows: Iterable[dict[str, Any]]) -> int:
-	count = 0
-	for row in rows:
-		props = row.get("properties", {})
-		ip_configs = props.get("ipConfigurations") or []
-		ip_conf = ip_configs[0] if ip_configs else {}
-		ip_props = ip_conf.get("properties", {})
-		cursor.execute(
-			"""
-IF EXISTS (SELECT 1 FROM dbo.network_interfaces WHERE resource_id = ?)
-	UPDATE dbo.network_interfaces SET
-		name=?, subscription_id=TRY_CONVERT(uniqueidentifier, ?), resource_group=?, location=?, mac_address=?, private_ip=?,
-		allocation_method=?, accelerated=?, primary_flag=?, vm_resource_id=?
-	WHERE resource_id=?
-ELSE
-	INSERT INTO dbo.network_interfaces (
-		resource_id,name,subscription_id,resource_group,location,mac_address,private_ip,allocation_method,accelerated,primary_flag,vm_resource_id
-	) VALUES (?, ?, TRY_CONVERT(uniqueidentifier, ?), ?, ?, ?, ?, ?, ?, ?, ?);
-""",
-			row.get("id"),
-			row.get("name"),
-			row.get("subscriptionId"),
-			row.get("resourceGroup"),
-			row.get("location"),
-			props.get("macAddress"),
-			ip_props.get("privateIPAddress"),
-			ip_props.get("privateIPAllocationMethod") or ip_props.get("privateIPAllocationMethod"),
-			1 if props.get("enableAcceleratedNetworking") else 0,
-			1 if (props.get("primary") or ip_props.get("primary")) else 0,
-			(props.get("virtualMachine") or {}).get("id"),
-			row.get("id"),  # WHERE
-			# INSERT
-			row.get("id"),
-			row.get("name"),
-			row.get("subscriptionId"),
-			row.get("resourceGroup"),
-			row.get("location"),
-			props.get("macAddress"),
-			ip_props.get("privateIPAddress"),
-			ip_props.get("privateIPAllocationMethod") or ip_props.get("privateIPAllocationMethod"),
-			1 if props.get("enableAcceleratedNetworking") else 0,
-			1 if (props.get("primary") or ip_props.get("primary")) else 0,
-			(props.get("virtualMachine") or {}).get("id"),
-		)
-		count += 1
-	return count
+	params = [nic_params(row) for row in rows]
+	executemany_chunked(cursor, NIC_UPSERT_SQL, params)
+	return len(params)
 
 
 def insert_installed_software(cursor: pyodbc.Cursor, rows: Iterable[dict[str, Any]]) -> int:
-	count = 0
-	for row in rows:
-		cursor.execute(
-			"""
-IF NOT EXISTS (
-	SELECT 1 FROM dbo.installed_software WHERE computer_name = ? AND software_name = ? AND ISNULL(current_version,'') = ISNULL(?, '')
-)
-	INSERT INTO dbo.installed_software (computer_name,software_name,current_version,publisher)
-	VALUES (?,?,?,?);
-""",
-			row.get("Computer"),
-			row.get("SoftwareName"),
-			row.get("CurrentVersion"),
-			row.get("Computer"),
-			row.get("SoftwareName"),
-			row.get("CurrentVersion"),
-			row.get("Publisher"),
+	# Bulk load into a session temp table, then add only the new rows in one set-based statement
+	cursor.execute(SW_STAGE_DDL)
+	# rows may be a streaming iterator: stage it chunk by chunk so memory stays O(chunk)
+	rows = iter(rows)
+	while True:
+		params = [
+			(row.get("Computer"), row.get("SoftwareName"), row.get("CurrentVersion"), row.get("Publisher"))
+			for row in itertools.islice(rows, EXECUTEMANY_CHUNK_SIZE)
+		]
+		if not params:
+			break
+		cursor.executemany(
+			"INSERT INTO #stage_sw (computer_name,software_name,current_version,publisher) VALUES (?,?,?,?);",
+			params,
 		)
-		count += cursor.rowcount if cursor.rowcount else 0
+	cursor.execute(SW_INSERT_NEW_SQL)
+	count = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+	cursor.execute("DROP TABLE #stage_sw;")
 	return count
 
 
@@ -287,14 +346,18 @@ def main() -> None:
 		sys.exit(1)
 
 	with get_connection() as conn:
+		# Table DDL commits on its own; the three data phases then share one transaction
+		conn.autocommit = False
 		cursor = conn.cursor()
+		# Pack executemany parameters into arrays and send them in one round-trip per batch
+		cursor.fast_executemany = True
 		ensure_tables(cursor)
 		conn.commit()
 
 		vm_rows = load_json_array(VM_FILE)
 		nic_rows = load_json_array(NIC_FILE)
-		# Software is large, so stream processing (bulk loading is also possible)
-		sw_rows = load_json_array(SW_FILE)
+		# Software is large, so stream it straight from the file into the staging table
+		sw_rows = iter_json_array(SW_FILE)
 
 		total_vm = upsert_virtual_machines(cursor, vm_rows)
 		print("Virtual Machine Data Uploaded.")
@@ -302,6 +365,7 @@ def main() -> None:
 		print("Network Interface Data Uploaded.")
 		total_sw = insert_installed_software(cursor, sw_rows)
 		print("Installed Software Data Uploaded.")
+		# Single commit for VMs, NICs and software: one log flush instead of one per phase
 		conn.commit()
 
 	print("Import complete:")
@@ -1,124 +1,188 @@
 import os
+import asyncio
 import hashlib
+import logging
 import time
-import traceback
-from datetime import datetime
+from collections import Counter
 from dotenv import load_dotenv
-from azure.storage.blob import BlobServiceClient
-from azure.identity import DefaultAzureCredential
-
-
-def _ts() -> str:
-    """Return current timestamp string with millisecond precision."""
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-
-
-def log(msg: str) -> None:
-    """Print log line with timestamp and flush immediately."""
-    print(f"[{_ts()}] {msg}", flush=True)
-
-overall_start = time.perf_counter()
-log("Script start: upload_data_to_blob_storage")
-
-load_dotenv()
-log("Loaded .env (if present)")
-
-storage_account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME", "")
-STORAGE_ACCOUNT_URL = f"https://{storage_account_name}.blob.core.windows.net" if storage_account_name else ""
-if storage_account_name:
-    log(f"Using storage account: {storage_account_name}")
-else:
-    log("Warning: AZURE_STORAGE_ACCOUNT_NAME is empty")
-
-cred_start = time.perf_counter()
-CREDENTIAL = DefaultAzureCredential()
-log(f"Initialized DefaultAzureCredential in {(time.perf_counter() - cred_start):.3f}s")
-
-client_start = time.perf_counter()
-blob_service_client = BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=CREDENTIAL)
-log(f"Connected to Blob Storage (client init {(time.perf_counter() - client_start):.3f}s)")
-container = "inventories"
-doc = "Sample_Server_Inventories.json"
-
-container_client = blob_service_client.get_container_client(container)
-log(f"Got container client for '{container}'")
-docid = hashlib.sha256(doc.encode("utf-8")).hexdigest()
-doc_path = os.path.join("sample-data", doc)
-size = os.path.getsize(doc_path) if os.path.isfile(doc_path) else None
-if size is None:
-    log(f"Warning: file not found -> {doc_path}")
-else:
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
+from azure.identity.aio import DefaultAzureCredential
+
+
+# Timestamped lines with millisecond precision; per-file detail is DEBUG, progress and summary are INFO
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s.%(msecs)03d] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+# Keep the SDK's per-request HTTP logging out of the INFO output
+logging.getLogger("azure").setLevel(logging.WARNING)
+logger = logging.getLogger("upload_data_to_blob_storage")
+
+# Emit one INFO progress line per this many finished incident files
+PROGRESS_EVERY = 100
+
+def make_docid(name: str) -> str:
+    """Stable document id for a blob name (SHA-256 used as an identifier, not for security)."""
+    return hashlib.sha256(name.encode("utf-8"), usedforsecurity=False).hexdigest()
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def iter_files(path: str):
+    """Recursively yield a DirEntry for every non-directory under path (stat info comes from the scan)."""
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            else:
+                yield entry
+
+
+async def blob_is_unchanged(container_client: ContainerClient, name: str, docid: str, size: int, content_md5: bytes) -> bool:
+    """True when the remote blob already has this docid, size and content hash (one HEAD request)."""
     try:
-        log(f"Uploading {doc_path} -> {container}/{doc} (docid={docid}, size={size} bytes)")
+        props = await container_client.get_blob_client(name).get_blob_properties()
+    except ResourceNotFoundError:
+        return False
+    remote_md5 = props.content_settings.content_md5
+    return (
+        props.metadata.get("docid") == docid
+        and props.size == size
+        and remote_md5 is not None
+        and bytes(remote_md5) == content_md5
+    )
+
+
+async def upload_file(container_client: ContainerClient, file_path: str, blob_name: str, docid: str, size: int, stats: Counter) -> None:
+    """Upload one file unless the remote copy is identical; outcomes are tallied in stats."""
+    try:
+        # File reads are blocking, so keep them off the event loop; the MD5 comes from the same bytes
+        data = await asyncio.to_thread(read_file, file_path)
+        # The scan-time size is stale if the file changed since; length, MD5 and stats must describe these bytes
+        size = len(data)
+        content_md5 = hashlib.md5(data, usedforsecurity=False).digest()
+        if await blob_is_unchanged(container_client, blob_name, docid, size, content_md5):
+            logger.debug("Skipped %s (unchanged)", blob_name)
+            stats["skipped"] += 1
+            return
+        logger.debug("Uploading %s -> %s/%s (docid=%s, size=%d bytes)", file_path, container_client.container_name, blob_name, docid, size)
         up_start = time.perf_counter()
-        with open(doc_path, "rb") as data:
-            container_client.upload_blob(
-                name=doc,
-                data=data,
-                overwrite=True,
-                metadata={"docid": docid}
-            )
-        elapsed = time.perf_counter() - up_start
-        mbps = (size / (1024 * 1024)) / elapsed if elapsed > 0 else float("inf")
-        log(f"Uploaded {doc} in {elapsed:.3f}s ({size} bytes, {mbps:.2f} MB/s)")
-    except Exception as e:
-        log(f"ERROR uploading {doc_path}: {e}")
-        traceback.print_exc()
-
-container = "incidents"
-folder = "sample-data/incidents"
-container_client = blob_service_client.get_container_client(container)
-log(f"Got container client for '{container}' (folder={folder})")
-
-total_files = 0
-uploaded_files = 0
-failed_files = 0
-total_bytes = 0
-walk_start = time.perf_counter()
-for root, _, files in os.walk(folder):
-    for file in files:
-        if file == "inc_format.md":
-            log(f"Skip template file: {os.path.join(root, file)}")
-            continue
-        file_path = os.path.join(root, file)
-        blob_path = os.path.relpath(file_path, folder).replace("\\", "/")
-        docid = hashlib.sha256(blob_path.encode("utf-8")).hexdigest()
-        size = os.path.getsize(file_path) if os.path.isfile(file_path) else None
-        total_files += 1
-        if size is None:
-            log(f"Warning: file not found -> {file_path}")
-            failed_files += 1
-            continue
-        try:
-            log(f"Uploading {file_path} -> {container}/{blob_path} (docid={docid}, size={size} bytes)")
-            up_start = time.perf_counter()
-            with open(file_path, "rb") as data:
-                container_client.upload_blob(
-                    name=blob_path,
-                    data=data,
-                    overwrite=True,
-                    metadata={"docid": docid}
-                )
+        await container_client.upload_blob(
+            name=blob_name,
+            data=data,
+            length=size,
+            overwrite=True,
+            metadata={"docid": docid},
+            content_settings=ContentSettings(content_md5=content_md5),
+            max_concurrency=8
+        )
+        if logger.isEnabledFor(logging.DEBUG):
             elapsed = time.perf_counter() - up_start
             mbps = (size / (1024 * 1024)) / elapsed if elapsed > 0 else float("inf")
-            log(f"Uploaded {blob_path} in {elapsed:.3f}s ({size} bytes, {mbps:.2f} MB/s)")
-            uploaded_files += 1
-            total_bytes += size
-        except Exception as e:
-            log(f"ERROR uploading {file_path}: {e}")
-            traceback.print_exc()
-            failed_files += 1
-
-walk_elapsed = time.perf_counter() - walk_start
-log(f"File enumeration and upload loop completed in {walk_elapsed:.3f}s")
-
-overall_elapsed = time.perf_counter() - overall_start
-avg_mbps = (total_bytes / (1024 * 1024)) / overall_elapsed if overall_elapsed > 0 else 0.0
-log(
-    "Summary: "
-    f"success={uploaded_files}, failed={failed_files}, total_files_seen={total_files}, "
-    f"bytes_uploaded={total_bytes} ({total_bytes/(1024*1024):.2f} MB), "
-    f"overall_time={overall_elapsed:.3f}s, avg_throughput={avg_mbps:.2f} MB/s"
-)
-
-log("Script end: upload_data_to_blob_storage")
+            logger.debug("Uploaded %s in %.3fs (%d bytes, %.2f MB/s)", blob_name, elapsed, size, mbps)
+        stats["uploaded"] += 1
+        stats["bytes"] += size
+    except Exception as e:
+        logger.exception("ERROR uploading %s: %s", file_path, e)
+        stats["failed"] += 1
+
+
+async def main() -> None:
+    overall_start = time.perf_counter()
+    logger.info("Script start: upload_data_to_blob_storage")
+
+    load_dotenv()
+    logger.info("Loaded .env (if present)")
+
+    storage_account_name = os.getenv("AZURE_STORAGE_ACCOUNT_NAME", "")
+    storage_account_url = f"https://{storage_account_name}.blob.core.windows.net" if storage_account_name else ""
+    if storage_account_name:
+        logger.info("Using storage account: %s", storage_account_name)
+    else:
+        logger.warning("Warning: AZURE_STORAGE_ACCOUNT_NAME is empty")
+
+    upload_concurrency = int(os.getenv("UPLOAD_CONCURRENCY", "32"))
+    stats: Counter = Counter()
+
+    cred_start = time.perf_counter()
+    credential = DefaultAzureCredential()
+    logger.info("Initialized DefaultAzureCredential in %.3fs", time.perf_counter() - cred_start)
+
+    client_start = time.perf_counter()
+    blob_service_client = BlobServiceClient(
+        account_url=storage_account_url,
+        credential=credential,
+        max_block_size=8 * 1024 * 1024,
+        max_single_put_size=64 * 1024 * 1024,
+        connection_data_block_size=8 * 1024 * 1024,
+    )
+    logger.info("Connected to Blob Storage (client init %.3fs)", time.perf_counter() - client_start)
+
+    async with credential, blob_service_client:
+        container = "inventories"
+        doc = "Sample_Server_Inventories.json"
+
+        container_client = blob_service_client.get_container_client(container)
+        logger.info("Got container client for '%s'", container)
+        doc_path = os.path.join("sample-data", doc)
+        size = os.path.getsize(doc_path) if os.path.isfile(doc_path) else None
+        if size is None:
+            logger.warning("Warning: file not found -> %s", doc_path)
+        else:
+            # The inventory upload is not part of the incident summary counts
+            doc_stats: Counter = Counter()
+            await upload_file(container_client, doc_path, doc, make_docid(doc), size, doc_stats)
+            logger.info("Inventories: %s %s", doc, "uploaded" if doc_stats["uploaded"] else "skipped (unchanged)" if doc_stats["skipped"] else "failed")
+
+        container = "incidents"
+        folder = "sample-data/incidents"
+        container_client = blob_service_client.get_container_client(container)
+        logger.info("Got container client for '%s' (folder=%s)", container, folder)
+
+        walk_start = time.perf_counter()
+        jobs = []
+        for entry in iter_files(folder):
+            if entry.name == "inc_format.md":
+                logger.debug("Skip template file: %s", entry.path)
+                continue
+            blob_path = os.path.relpath(entry.path, folder).replace("\\", "/")
+            docid = make_docid(blob_path)
+            size = entry.stat().st_size if entry.is_file() else None
+            if size is None:
+                logger.warning("Warning: file not found -> %s", entry.path)
+                stats["failed"] += 1
+                continue
+            jobs.append((entry.path, blob_path, docid, size))
+        total_files = len(jobs) + stats["failed"]
+
+        # Uploads are network-bound: keep many requests in flight on one event loop, bounded by a semaphore
+        semaphore = asyncio.Semaphore(upload_concurrency)
+
+        async def _bounded_upload(job: tuple) -> None:
+            async with semaphore:
+                await upload_file(container_client, *job, stats)
+            stats["done"] += 1
+            if stats["done"] % PROGRESS_EVERY == 0:
+                logger.info("Progress: %d/%d incident files processed", stats["done"], len(jobs))
+
+        await asyncio.gather(*(_bounded_upload(job) for job in jobs))
+
+        walk_elapsed = time.perf_counter() - walk_start
+        logger.info("File enumeration and upload loop completed in %.3fs", walk_elapsed)
+
+    total_bytes = stats["bytes"]
+    overall_elapsed = time.perf_counter() - overall_start
+    avg_mbps = (total_bytes / (1024 * 1024)) / overall_elapsed if overall_elapsed > 0 else 0.0
+    logger.info(
+        "Summary: success=%d, skipped=%d, failed=%d, total_files_seen=%d, "
+        "bytes_uploaded=%d (%.2f MB), overall_time=%.3fs, avg_throughput=%.2f MB/s",
+        stats["uploaded"], stats["skipped"], stats["failed"], total_files,
+        total_bytes, total_bytes / (1024 * 1024), overall_elapsed, avg_mbps,
+    )
+
+    logger.info("Script end: upload_data_to_blob_storage")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())